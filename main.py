@@ -2,7 +2,8 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
-import json, asyncio, sqlite3, time, uuid, copy, traceback
+import json, asyncio, sqlite3, time, uuid, copy, traceback, hashlib
+from collections import OrderedDict
 import uvicorn
 import os
 
@@ -22,9 +23,37 @@ app.mount("/static", StaticFiles(directory=static_path), name="static")
 # Ưu tiên thư mục data của Render, nếu không có (chạy local) thì lưu ở BASE_DIR
 DATA_DIR = os.environ.get('DATA_DIR', BASE_DIR)
 DB_PATH = os.path.join(DATA_DIR, 'games.db')
+SNAPSHOT_PATH = os.path.join(DATA_DIR, 'rooms_snapshot.json')
 # -----------------------------
 
 # ------------------ Database init ------------------
+def read_snapshot():
+    try:
+        with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[SNAPSHOT] Error reading snapshot: {e}")
+        return None
+
+def repair_orphaned_games(live_ids=()):
+    # Đóng các ván bị bỏ dở (server chết giữa trận), trừ những ván sẽ được khôi phục từ snapshot
+    live_ids = list(live_ids)
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute(f"""
+        UPDATE games SET end_ts = COALESCE((SELECT MAX(ts) FROM moves WHERE moves.game_id = games.id), start_ts)
+        WHERE end_ts IS NULL AND id NOT IN ({",".join("?" * len(live_ids))})
+        """, live_ids)
+        if c.rowcount > 0:
+            print(f"[DB] Closed {c.rowcount} orphaned unfinished games.")
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"[DB] Error repair_orphaned_games: {e}")
+
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -50,9 +79,12 @@ def init_db():
         ts INTEGER
     )
     """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_moves_game ON moves(game_id, move_index)")
     conn.commit()
     conn.close()
 
+    repair_orphaned_games(r["game_id"] for r in (read_snapshot() or {}).get("rooms", []) if r.get("game_id"))
+
 init_db()
 
 # ------------------ In-memory structures ------------------
@@ -63,6 +95,27 @@ pending_challenges = {}   # { target_name: challenger_name }
 pending_challenge_targets = {}  # { challenger_name: target_name }
 lock = asyncio.Lock()
 
+OPENING_BOOK_DEPTH = 20   # số nước đầu tiên của mỗi ván được đưa vào opening book
+OPENING_BOOK_MAX_POSITIONS = 50000
+OPENING_BOOK_HOT_GAMES = 20     # thế cờ xuất hiện từ chừng này ván trở lên mới được sinh sẵn nước đi
+POSITION_CACHE_SIZE = 4096
+opening_book = {}         # { position_hash: { move_key: {"games", "red_wins", "black_wins"} } }
+opening_book_counts = {}  # { position_hash: tổng số ván đi qua thế cờ }
+position_cache = OrderedDict()  # LRU { position_hash: frozenset(move_key) }
+
+TOURNAMENT_FORMATS = ("swiss", "arena")
+TOURNAMENT_ROUND_DELAY = 5  # giây nghỉ giữa hai vòng đấu
+SWISS_PAIRING_BUDGET = 200000  # số bước quay lui tối đa khi ghép cặp Swiss
+SWISS_LOOKAHEAD_PLAYERS = 16   # giải từ chừng này người trở xuống thì ghép có tính trước các vòng sau
+SWISS_LOOKAHEAD_BUDGET = 20000
+tournaments = {}          # { tournament_id: {...} }
+tournament_tasks = set()  # giữ tham chiếu các task lên lịch vòng đấu để không bị GC thu hồi giữa chừng
+
+RECONNECT_GRACE = 60      # giây không trừ đồng hồ khi người đến lượt chưa kết nối lại sau khi khôi phục
+restored_players = {}     # { player_name: room_id } chờ kết nối lại sau khi khôi phục snapshot
+shutting_down = False
+server_loop = None
+
 # ------------------ Game logic helpers ------------------
 def init_board():
     board = [["" for _ in range(9)] for _ in range(10)]
@@ -232,6 +285,21 @@ def create_game_record(room_id, player_red, player_black):
         print(f"[DB] Error create_game_record: {e}")
         return None
 
+def create_game_records(pairs):
+    # Tạo nhiều ván cùng lúc trong một transaction: pairs = [(room_id, player_red, player_black)]
+    ts = int(time.time())
+    rows = [(str(uuid.uuid4()), room_id, red, black, ts) for room_id, red, black in pairs]
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.executemany("INSERT INTO games(id, room, player_red, player_black, start_ts) VALUES (?,?,?,?,?)", rows)
+        conn.commit()
+        conn.close()
+        return [r[0] for r in rows]
+    except Exception as e:
+        print(f"[DB] Error create_game_records: {e}")
+        return [None] * len(rows)
+
 def add_move_record(game_id, idx, fx, fy, tx, ty, piece):
     ts = int(time.time())
     try:
@@ -256,6 +324,104 @@ def finish_game_record(game_id, winner):
     except Exception as e:
         print(f"[DB] Error finish_game_record: {e}")
 
+# ------------------ Opening book & position cache ------------------
+def position_hash(board, turn: str) -> str:
+    key = turn + "|" + "/".join("".join(cell or "." for cell in row) for row in board)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def move_key(fx, fy, tx, ty) -> str:
+    return f"{fx}{fy}{tx}{ty}"
+
+def parse_move_key(key: str):
+    if len(key) != 4 or not key.isdigit(): return None
+    fx, fy, tx, ty = (int(ch) for ch in key)
+    return {"from": {"x": fx, "y": fy}, "to": {"x": tx, "y": ty}}
+
+def compute_legal_moves(board, turn: str):
+    legal = set()
+    for fy in range(10):
+        for fx in range(9):
+            if get_color(board[fy][fx]) != turn: continue
+            for ty in range(10):
+                for tx in range(9):
+                    move = {"from": {"x": fx, "y": fy}, "to": {"x": tx, "y": ty}}
+                    if is_valid_move(board, move, turn)[0]:
+                        legal.add(move_key(fx, fy, tx, ty))
+    return frozenset(legal)
+
+def is_hot_position(pos_hash: str) -> bool:
+    return opening_book_counts.get(pos_hash, 0) >= OPENING_BOOK_HOT_GAMES
+
+def get_legal_moves(board, turn: str, pos_hash: str = None):
+    # Chỉ dùng cho thế cờ "nóng": sinh toàn bộ nước đi tốn vài ms, đổi lại các lần sau chỉ là tra cứu
+    pos_hash = pos_hash or position_hash(board, turn)
+    legal = position_cache.get(pos_hash)
+    if legal is not None:
+        position_cache.move_to_end(pos_hash)
+        return legal
+    legal = compute_legal_moves(board, turn)
+    position_cache[pos_hash] = legal
+    if len(position_cache) > POSITION_CACHE_SIZE:
+        position_cache.popitem(last=False)
+    return legal
+
+def prune_opening_book():
+    # Bỏ dần các thế cờ hiếm gặp cho tới khi book còn 90% giới hạn
+    threshold = 1
+    while len(opening_book) > OPENING_BOOK_MAX_POSITIONS * 9 // 10:
+        for pos_hash in [h for h, n in opening_book_counts.items() if n <= threshold]:
+            opening_book.pop(pos_hash, None)
+            opening_book_counts.pop(pos_hash, None)
+        threshold += 1
+    print(f"[BOOK] Pruned to {len(opening_book)} positions (min games {threshold}).")
+
+def opening_book_add_game(move_keys, winner):
+    # Phát lại các nước đầu từ thế cờ ban đầu, cộng dồn thống kê vào book
+    board = init_board()["board"]
+    turn = "red"
+    for key in move_keys[:OPENING_BOOK_DEPTH]:
+        move = parse_move_key(key)
+        if move is None: return
+        fx, fy = move["from"]["x"], move["from"]["y"]
+        if get_color(board[fy][fx]) != turn: return
+        pos_hash = position_hash(board, turn)
+        stats = opening_book.setdefault(pos_hash, {}).setdefault(
+            key, {"games": 0, "red_wins": 0, "black_wins": 0})
+        stats["games"] += 1
+        opening_book_counts[pos_hash] = opening_book_counts.get(pos_hash, 0) + 1
+        if winner == "red": stats["red_wins"] += 1
+        elif winner == "black": stats["black_wins"] += 1
+        apply_move({"board": board}, move)
+        turn = get_opponent_color(turn)
+    if len(opening_book) > OPENING_BOOK_MAX_POSITIONS:
+        prune_opening_book()
+
+def build_opening_book():
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute("""
+        SELECT m.game_id, g.winner, m.from_x, m.from_y, m.to_x, m.to_y
+        FROM moves m JOIN games g ON g.id = m.game_id
+        WHERE g.end_ts IS NOT NULL AND g.winner IS NOT NULL AND m.move_index <= ?
+        ORDER BY m.game_id, m.move_index
+        """, (OPENING_BOOK_DEPTH,))
+        rows = c.fetchall()
+        conn.close()
+    except Exception as e:
+        print(f"[DB] Error build_opening_book: {e}")
+        return
+    current_id, winner, keys = None, None, []
+    for gid, w, fx, fy, tx, ty in rows:
+        if gid != current_id:
+            if keys: opening_book_add_game(keys, winner)
+            current_id, winner, keys = gid, w, []
+        keys.append(move_key(fx, fy, tx, ty))
+    if keys: opening_book_add_game(keys, winner)
+    print(f"[BOOK] Loaded {len(opening_book)} positions from history.")
+
+build_opening_book()
+
 # ------------------ Core send/broadcast helpers ------------------
 async def broadcast_to_room(room_id: str, message: dict, exclude_ws: WebSocket = None):
     if room_id not in rooms: return
@@ -319,6 +485,9 @@ async def send_game_over(room_id, winner, reason):
 
     if game.get("game_id"):
         finish_game_record(game["game_id"], winner)
+        opening_book_add_game(game.get("book_moves", []), winner)
+        if game.get("tournament_id"):
+            tournament_record_result(game["tournament_id"], room_id, winner)
 
     game["game_id"] = None
     game["rematch_offered_by"] = None
@@ -326,6 +495,28 @@ async def send_game_over(room_id, winner, reason):
     msg = {"type": "game_over", "winner": winner, "reason": reason}
     await broadcast_to_room(room_id, msg)
 
+# ------------------ Room creation ------------------
+def open_room(room_id, red_ws, red_name, black_ws, black_name, game_id, tournament_id=None):
+    lobby.pop(red_ws, None)
+    lobby.pop(black_ws, None)
+    player_room_map[red_ws] = room_id
+    player_room_map[black_ws] = room_id
+    rooms[room_id] = {
+        "players": {black_ws: black_name, red_ws: red_name},
+        "player_colors": {red_name: 'red', black_name: 'black'},
+        "turn": "red",
+        "state": init_board(),
+        "game_id": game_id,
+        "move_count": 0,
+        "book_moves": [],
+        "clocks": {"red": 300, "black": 300},
+        "timer_task": None,
+        "rematch_offered_by": None,
+        "tournament_id": tournament_id
+    }
+    rooms[room_id]["timer_task"] = asyncio.create_task(timer_loop(room_id))
+    return rooms[room_id]
+
 # ------------------ Timer loop ------------------
 async def timer_loop(room_id: str):
     print(f"[TIMER] Starting for room {room_id}")
@@ -336,9 +527,12 @@ async def timer_loop(room_id: str):
                 if room_id not in rooms:
                     break
                 game = rooms[room_id]
-                if game.get("game_id") is None:
+                if game.get("game_id") is None or shutting_down:
                     continue
                 turn = game["turn"]
+                if game.get("restored_ts") and time.time() - game["restored_ts"] < RECONNECT_GRACE and \
+                        turn not in [game["player_colors"].get(n) for n in game["players"].values()]:
+                    continue
                 game["clocks"][turn] -= 1
                 await broadcast_to_room(room_id, {"type": "clock_update", "clocks": game["clocks"]})
                 if game["clocks"][turn] <= 0:
@@ -346,6 +540,8 @@ async def timer_loop(room_id: str):
                     reason = f"{turn} hết giờ"
                     print(f"[TIMER] Room {room_id} - {turn} ran out. Winner: {winner}")
                     await send_game_over(room_id, winner, reason)
+                    if not game["players"]:
+                        del rooms[room_id]
                     break
     except asyncio.CancelledError:
         print(f"[TIMER] Cancelled for room {room_id}")
@@ -359,6 +555,14 @@ async def timer_loop(room_id: str):
 # ------------------ Cleanup on disconnect or leave ------------------
 async def cleanup_player(ws: WebSocket):
     async with lock:
+        if shutting_down:
+            # Đang tắt server: giữ nguyên phòng để snapshot, không xử thua người chơi
+            lobby.pop(ws, None)
+            room_id = player_room_map.pop(ws, None)
+            if room_id in rooms:
+                rooms[room_id]["players"].pop(ws, None)
+            return
+
         if ws in lobby:
             name = lobby.pop(ws)
             print(f"[CLEANUP] Lobby player '{name}' disconnected/left.")
@@ -415,6 +619,394 @@ def get_opponent_ws(room_id: str, self_ws: WebSocket):
             return ws
     return None
 
+# ------------------ Tournaments (Swiss / Arena) ------------------
+def create_tournament(name, fmt, creator, rounds, duration, start_in):
+    tid = str(uuid.uuid4())[:8]
+    now = time.time()
+    tournaments[tid] = {
+        "id": tid,
+        "name": name or f"Giải {tid}",
+        "format": fmt,
+        "creator": creator,
+        "rounds": rounds,                       # swiss: số vòng
+        "start_ts": now + start_in,
+        "end_ts": now + start_in + duration,    # arena: hết giờ thì không ghép vòng mới
+        "status": "waiting",
+        "round": 0,
+        "players": {},                          # { name: {...thống kê...} }
+        "active_rooms": {}                      # { room_id: (red_name, black_name) }
+    }
+    return tournaments[tid]
+
+def spawn_tournament_task(coro):
+    task = asyncio.create_task(coro)
+    tournament_tasks.add(task)
+    task.add_done_callback(tournament_tasks.discard)
+    return task
+
+def tournament_add_player(t, name):
+    t["players"].setdefault(name, {
+        "score": 0, "wins": 0, "losses": 0, "byes": 0,
+        "streak": 0, "reds": 0, "opponents": set(), "last_opponent": None
+    })
+
+def tournament_summary(t):
+    return {
+        "id": t["id"], "name": t["name"], "format": t["format"], "status": t["status"],
+        "round": t["round"], "rounds": t["rounds"] if t["format"] == "swiss" else None,
+        "start_ts": int(t["start_ts"]), "players": len(t["players"]), "games": len(t["active_rooms"])
+    }
+
+def tournament_standings(t):
+    ranked = sorted(t["players"].items(), key=lambda kv: (-kv[1]["score"], -kv[1]["wins"], kv[0]))
+    return [{"rank": i + 1, "player": name, "score": st["score"], "wins": st["wins"],
+             "losses": st["losses"], "byes": st["byes"]} for i, (name, st) in enumerate(ranked)]
+
+def tournament_record_result(tid, room_id, winner):
+    # Gọi từ send_game_over (đang giữ lock): cập nhật bảng điểm ngay, không đọc lại DB
+    t = tournaments.get(tid)
+    if not t or room_id not in t["active_rooms"]: return
+    red_name, black_name = t["active_rooms"].pop(room_id)
+    for name, color in ((red_name, "red"), (black_name, "black")):
+        st = t["players"][name]
+        if color == winner:
+            st["wins"] += 1
+            if t["format"] == "arena":
+                # Arena: thắng 2 điểm, nhân đôi khi đang có chuỗi từ 2 trận thắng
+                st["score"] += 4 if st["streak"] >= 2 else 2
+            else:
+                st["score"] += 1
+            st["streak"] += 1
+        else:
+            st["losses"] += 1
+            st["streak"] = 0
+    if not t["active_rooms"] and t["status"] == "running":
+        spawn_tournament_task(run_tournament_round(tid, delay=TOURNAMENT_ROUND_DELAY))
+
+def _match_without_repeats(opponents, order, budget, accept=None):
+    # Ghép theo thứ hạng, quay lui (trong và giữa các nhóm điểm) khi không còn đối thủ mới.
+    # Duyệt bằng stack thay vì đệ quy để không vướng giới hạn đệ quy với giải đông người.
+    stack = []            # [(danh sách chưa ghép tại bước đó, vị trí đối thủ thử tiếp theo)]
+    pairs = []
+    unpaired, start = order, 1
+    while True:
+        budget[0] -= 1
+        if budget[0] < 0: return None
+        i = None
+        if unpaired:
+            p = unpaired[0]
+            i = next((k for k in range(start, len(unpaired)) if unpaired[k] not in opponents[p]), None)
+        elif accept is None or accept(pairs):
+            return pairs
+        if i is None:
+            if not stack: return None
+            unpaired, start = stack.pop()
+            pairs.pop()
+            continue
+        stack.append((unpaired, i + 1))
+        pairs.append((p, unpaired[i]))
+        unpaired, start = unpaired[1:i] + unpaired[i + 1:], 1
+
+def _can_finish_without_repeats(opponents, names, rounds_left, budget):
+    # Còn xếp được rounds_left vòng nữa mà không ai gặp lại nhau không (mỗi vòng lẻ người có một bye)
+    if rounds_left <= 0: return True
+    order = sorted(names)
+    for bye in (order if len(order) % 2 == 1 else [None]):
+        rest = [n for n in order if n != bye]
+        if _match_without_repeats(opponents, rest, budget,
+                                  lambda pairs: _can_finish_without_repeats(
+                                      _with_pairs(opponents, pairs), names, rounds_left - 1, budget)) is not None:
+            return True
+        if budget[0] < 0: return False
+    return False
+
+def _with_pairs(opponents, pairs):
+    merged = {n: set(opp) for n, opp in opponents.items()}
+    for p, q in pairs:
+        merged[p].add(q)
+        merged[q].add(p)
+    return merged
+
+def pair_swiss(t, names):
+    players = t["players"]
+    opponents = {n: players[n]["opponents"] for n in names}
+    order = sorted(names, key=lambda n: (-players[n]["score"], n))
+    # Ứng viên bye: ít lần miễn đấu nhất trước, trong đó người xếp thấp nhất trước
+    candidates = sorted(reversed(order), key=lambda n: players[n]["byes"]) if len(order) % 2 == 1 else [None]
+
+    # Giải ít người dễ "kẹt" ở các vòng cuối: chỉ nhận cách ghép còn cho phép đánh hết số vòng không gặp lại
+    rounds_left = t.get("rounds", 0) - t.get("round", 0) - 1
+    accept = None
+    if len(order) <= SWISS_LOOKAHEAD_PLAYERS and rounds_left > 0:
+        lookahead_budget = [SWISS_LOOKAHEAD_BUDGET]
+        def accept(pairs):
+            ok = _can_finish_without_repeats(_with_pairs(opponents, pairs), names, rounds_left, lookahead_budget)
+            return ok or lookahead_budget[0] < 0
+
+    for check in ([accept, None] if accept else [None]):
+        budget = [SWISS_PAIRING_BUDGET]
+        for bye in candidates:
+            pairs = _match_without_repeats(opponents, [n for n in order if n != bye], budget, check)
+            if pairs is not None: return pairs, bye
+            if budget[0] < 0: break
+
+    # Không có cách ghép nào tránh gặp lại (hoặc hết budget): ghép tham lam, chấp nhận gặp lại
+    bye = candidates[0]
+    unpaired = [n for n in order if n != bye]
+    pairs = []
+    while unpaired:
+        p = unpaired[0]
+        rest = unpaired[1:]
+        j = next((i for i, q in enumerate(rest) if q not in opponents[p]), 0)
+        pairs.append((p, rest[j]))
+        unpaired = rest[:j] + rest[j + 1:]
+    return pairs, bye
+
+def pair_arena(t, names):
+    players = t["players"]
+    order = sorted(names, key=lambda n: (-players[n]["score"], n))
+    bye = None
+    if len(order) % 2 == 1:
+        # Xoay vòng bye: người xếp thấp nhất trong số ít được miễn đấu nhất
+        bye = min(reversed(order), key=lambda n: players[n]["byes"])
+        order.remove(bye)
+    pairs = []
+    i = 0
+    while i < len(order):
+        p, q = order[i], order[i + 1]
+        # Tránh gặp lại đúng đối thủ vòng trước nếu có thể đổi với cặp kế tiếp
+        if players[p]["last_opponent"] == q and i + 2 < len(order):
+            order[i + 1], order[i + 2] = order[i + 2], order[i + 1]
+            q = order[i + 1]
+        pairs.append((p, q))
+        i += 2
+    return pairs, bye
+
+def detach_from_finished_room(ws):
+    # Đưa người chơi từ phòng đã kết thúc về sảnh; False nếu họ còn đang đánh ván khác
+    room_id = player_room_map.get(ws)
+    if room_id is None: return True
+    game = rooms.get(room_id)
+    if game and game.get("game_id") is not None: return False
+    player_room_map.pop(ws, None)
+    if game:
+        lobby[ws] = game["players"].pop(ws, None)
+        if not game["players"]:
+            if game.get("timer_task"):
+                try: game["timer_task"].cancel()
+                except: pass
+            del rooms[room_id]
+    return True
+
+async def send_many(items):
+    # items: [(websocket, message_dict)]
+    tasks = [ws.send_text(json.dumps(m, ensure_ascii=False)) for ws, m in items]
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run_tournament_round(tid, delay=0):
+    if delay: await asyncio.sleep(delay)
+    outgoing = []
+    retry = False
+    async with lock:
+        t = tournaments.get(tid)
+        # Đang tắt server: snapshot đã/đang được ghi, on_startup sẽ lên lịch lại vòng này
+        if not t or shutting_down or t["status"] == "finished" or t["active_rooms"]: return
+
+        done = (t["format"] == "swiss" and t["round"] >= t["rounds"]) or \
+               (t["format"] == "arena" and t["round"] > 0 and time.time() >= t["end_ts"])
+
+        # Một lượt duyệt để lập chỉ mục tên -> websocket, thay vì tìm từng người
+        ws_by_name = {name: ws for ws, name in lobby.items()}
+        for room in rooms.values():
+            for ws, name in room["players"].items():
+                ws_by_name.setdefault(name, ws)
+        available = []
+        if not done:
+            for name in t["players"]:
+                ws = ws_by_name.get(name)
+                if ws is not None and detach_from_finished_room(ws):
+                    available.append(name)
+
+        if not done and len(available) < 2:
+            # Thiếu người tạm thời (mất kết nối, đang đánh ván thường): arena chờ vòng sau nếu còn giờ
+            if t["format"] == "arena" and time.time() < t["end_ts"]:
+                retry = True
+            else:
+                done = True
+
+        if retry:
+            print(f"[TOURNAMENT] {tid} waiting for players ({len(available)} available).")
+        elif done:
+            t["status"] = "finished"
+            standings = tournament_standings(t)
+            print(f"[TOURNAMENT] {tid} finished after {t['round']} rounds.")
+            msg = {"type": "tournament_finished", "tournament": tournament_summary(t), "standings": standings[:50]}
+            outgoing = [(ws_by_name[n], msg) for n in t["players"] if n in ws_by_name]
+        else:
+            pairs, bye = (pair_swiss if t["format"] == "swiss" else pair_arena)(t, available)
+
+            matches = []
+            for p, q in pairs:
+                # Người cầm đỏ ít hơn sẽ được cầm đỏ
+                red, black = (p, q) if t["players"][p]["reds"] <= t["players"][q]["reds"] else (q, p)
+                matches.append((str(uuid.uuid4()), red, black))
+            game_ids = create_game_records(matches)
+            if None in game_ids:
+                # Không ghi được ván vào DB: chưa mở phòng nào, người chơi vẫn ở sảnh, thử lại sau
+                print(f"[TOURNAMENT] {tid} could not create games for round {t['round'] + 1}, retrying.")
+                retry = True
+
+        if not retry and not done:
+            t["status"] = "running"
+            t["round"] += 1
+            for (room_id, red, black), game_id in zip(matches, game_ids):
+                open_room(room_id, ws_by_name[red], red, ws_by_name[black], black, game_id, tournament_id=tid)
+                t["active_rooms"][room_id] = (red, black)
+                t["players"][red]["reds"] += 1
+                for a, b in ((red, black), (black, red)):
+                    t["players"][a]["opponents"].add(b)
+                    t["players"][a]["last_opponent"] = b
+                state = {"type": "state", "turn": "red", "state": rooms[room_id]["state"],
+                         "colors": rooms[room_id]["player_colors"], "clocks": rooms[room_id]["clocks"]}
+                outgoing += [
+                    (ws_by_name[red], {"type": "game_start", "room_id": room_id, "color": "red", "opponent": black, "tournament_id": tid}),
+                    (ws_by_name[black], {"type": "game_start", "room_id": room_id, "color": "black", "opponent": red, "tournament_id": tid}),
+                    (ws_by_name[red], state), (ws_by_name[black], state)
+                ]
+
+            if bye:
+                st = t["players"][bye]
+                st["byes"] += 1
+                if t["format"] == "swiss": st["score"] += 1
+                outgoing.append((ws_by_name[bye], {"type": "system", "text": f"Bạn được miễn đấu vòng {t['round']}."}))
+            print(f"[TOURNAMENT] {tid} round {t['round']}: {len(matches)} games, bye={bye}")
+
+    if retry:
+        spawn_tournament_task(run_tournament_round(tid, delay=TOURNAMENT_ROUND_DELAY))
+        return
+    await send_many(outgoing)
+    await send_lobby_update()
+
+async def tournament_scheduler(tid):
+    t = tournaments.get(tid)
+    if not t: return
+    await asyncio.sleep(max(0, t["start_ts"] - time.time()))
+    await run_tournament_round(tid)
+
+# ------------------ Snapshot / graceful shutdown ------------------
+def write_snapshot():
+    snapshot = {"ts": int(time.time()), "rooms": [], "tournaments": []}
+    for room_id, game in rooms.items():
+        if game.get("game_id") is None: continue
+        snapshot["rooms"].append({
+            "room_id": room_id,
+            "game_id": game["game_id"],
+            "players": game["player_colors"],
+            "turn": game["turn"],
+            "board": ["".join(cell or "." for cell in row) for row in game["state"]["board"]],
+            "clocks": game["clocks"],
+            "move_count": game["move_count"],
+            "book_moves": game.get("book_moves", []),
+            "tournament_id": game.get("tournament_id")
+        })
+    for t in tournaments.values():
+        if t["status"] == "finished": continue
+        t = dict(t)
+        t["players"] = {n: dict(st, opponents=sorted(st["opponents"])) for n, st in t["players"].items()}
+        snapshot["tournaments"].append(t)
+
+    tmp_path = SNAPSHOT_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, SNAPSHOT_PATH)
+    print(f"[SNAPSHOT] Saved {len(snapshot['rooms'])} rooms, {len(snapshot['tournaments'])} tournaments.")
+
+def restore_snapshot():
+    snapshot = read_snapshot()
+    if not snapshot: return
+    now = time.time()
+    for t in snapshot.get("tournaments", []):
+        for st in t["players"].values():
+            st["opponents"] = set(st["opponents"])
+        t["active_rooms"] = {rid: tuple(names) for rid, names in t["active_rooms"].items()}
+        tournaments[t["id"]] = t
+    for r in snapshot.get("rooms", []):
+        rooms[r["room_id"]] = {
+            "players": {},
+            "player_colors": r["players"],
+            "turn": r["turn"],
+            "state": {"board": [["" if ch == "." else ch for ch in row] for row in r["board"]]},
+            "game_id": r["game_id"],
+            "move_count": r["move_count"],
+            "book_moves": r["book_moves"],
+            "clocks": r["clocks"],
+            "timer_task": None,
+            "rematch_offered_by": None,
+            "tournament_id": r["tournament_id"],
+            "restored_ts": now
+        }
+        for name in r["players"]:
+            restored_players[name] = r["room_id"]
+    os.remove(SNAPSHOT_PATH)
+    print(f"[SNAPSHOT] Restored {len(snapshot.get('rooms', []))} rooms from {SNAPSHOT_PATH}")
+
+async def drain_connections():
+    notice = {"type": "system", "text": "Máy chủ đang khởi động lại, vui lòng kết nối lại sau giây lát."}
+    sockets = list(lobby.keys()) + list(player_room_map.keys())
+    await send_many([(ws, notice) for ws in sockets])
+    await asyncio.gather(*(ws.close(code=1012) for ws in sockets), return_exceptions=True)
+
+def begin_shutdown():
+    # Gọi từ signal handler, trước khi uvicorn đóng các websocket
+    global shutting_down
+    if shutting_down: return
+    shutting_down = True
+    print("[SHUTDOWN] Draining websockets...")
+    if server_loop:
+        server_loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain_connections()))
+
+@app.on_event("startup")
+async def on_startup():
+    global server_loop
+    server_loop = asyncio.get_running_loop()
+    try:
+        restore_snapshot()
+    except Exception as e:
+        print(f"[SNAPSHOT] Error restoring snapshot: {e}")
+        traceback.print_exc()
+        # Bỏ phần đã khôi phục dở, cất snapshot hỏng sang bên và đóng các ván init_db đã bỏ qua
+        rooms.clear()
+        tournaments.clear()
+        restored_players.clear()
+        try: os.replace(SNAPSHOT_PATH, SNAPSHOT_PATH + ".bad")
+        except OSError: pass
+        repair_orphaned_games()
+    for room_id, game in rooms.items():
+        game["timer_task"] = asyncio.create_task(timer_loop(room_id))
+    for tid, t in tournaments.items():
+        if t["status"] == "waiting":
+            spawn_tournament_task(tournament_scheduler(tid))
+        elif t["status"] == "running" and not t["active_rooms"]:
+            spawn_tournament_task(run_tournament_round(tid, delay=TOURNAMENT_ROUND_DELAY))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    global shutting_down
+    shutting_down = True
+    async with lock:
+        for game in rooms.values():
+            if game.get("timer_task"):
+                try: game["timer_task"].cancel()
+                except: pass
+                game["timer_task"] = None
+        # Mỗi nước đi/ván đấu đã được commit ngay khi ghi nên không còn gì phải flush vào DB
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"[SNAPSHOT] Error writing snapshot: {e}")
+            traceback.print_exc()
+
 # ------------------ HTTP routes ------------------
 @app.get("/")
 async def index():
@@ -435,6 +1027,44 @@ async def leaderboard():
         print(f"[DB] leaderboard error: {e}")
         return JSONResponse([])
 
+@app.get("/opening-explorer")
+async def opening_explorer(moves: str = ""):
+    # moves: chuỗi các nước "fxfytxty" ngăn cách bởi dấu phẩy, tính từ thế cờ ban đầu
+    board = init_board()["board"]
+    turn = "red"
+    for key in [k for k in moves.split(",") if k]:
+        move = parse_move_key(key)
+        if move is None or not is_valid_move(board, move, turn)[0]:
+            return JSONResponse({"error": f"Nước đi không hợp lệ: {key}"}, status_code=400)
+        apply_move({"board": board}, move)
+        turn = get_opponent_color(turn)
+
+    pos_hash = position_hash(board, turn)
+    entries = []
+    for key, stats in opening_book.get(pos_hash, {}).items():
+        wins = stats["red_wins"] if turn == "red" else stats["black_wins"]
+        entries.append({
+            "move": key,
+            "piece": board[int(key[1])][int(key[0])],
+            "games": stats["games"],
+            "red_wins": stats["red_wins"],
+            "black_wins": stats["black_wins"],
+            "win_rate": round(wins / stats["games"], 3) if stats["games"] else 0.0
+        })
+    entries.sort(key=lambda e: e["games"], reverse=True)
+    return JSONResponse({"position": pos_hash, "turn": turn, "moves": entries})
+
+@app.get("/tournaments")
+async def list_tournaments():
+    return JSONResponse([tournament_summary(t) for t in tournaments.values()])
+
+@app.get("/tournaments/{tournament_id}")
+async def get_tournament(tournament_id: str):
+    t = tournaments.get(tournament_id)
+    if not t:
+        return JSONResponse({"error": "Không tìm thấy giải đấu"}, status_code=404)
+    return JSONResponse({"tournament": tournament_summary(t), "standings": tournament_standings(t)})
+
 # ------------------ WebSocket endpoint ------------------
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -456,8 +1086,26 @@ async def websocket_endpoint(websocket: WebSocket):
             # ---------- JOIN LOBBY ----------
             if msg_type == "join_lobby":
                 player_name = msg.get("player") or ("P"+str(int(time.time())%1000))
+                resumed = None
                 async with lock:
-                    lobby[websocket] = player_name
+                    room_id = restored_players.pop(player_name, None)
+                    game = rooms.get(room_id)
+                    if game and game.get("game_id") and player_name not in game["players"].values():
+                        game["players"][websocket] = player_name
+                        player_room_map[websocket] = room_id
+                        resumed = room_id
+                    else:
+                        lobby[websocket] = player_name
+
+                if resumed:
+                    color = game["player_colors"][player_name]
+                    opponent = next((n for n in game["player_colors"] if n != player_name), None)
+                    print(f"[RESTORE] {player_name} resumed room {resumed}")
+                    await websocket.send_text(json.dumps({"type": "game_start", "room_id": resumed, "color": color, "opponent": opponent, "tournament_id": game.get("tournament_id")}, ensure_ascii=False))
+                    await send_state(resumed)
+                    await broadcast_to_room(resumed, {"type":"system","text":f"{player_name} đã kết nối lại."}, exclude_ws=websocket)
+                    continue
+
                 print(f"[LOBBY] {player_name} joined lobby.")
                 await websocket.send_text(json.dumps({"type":"system","text":f"Chào mừng {player_name} đến sảnh."}, ensure_ascii=False))
                 await send_lobby_update()
@@ -517,8 +1165,6 @@ async def websocket_endpoint(websocket: WebSocket):
                     if challenger_ws in lobby: del lobby[challenger_ws]
 
                     room_id = str(uuid.uuid4())
-                    player_room_map[websocket] = room_id
-                    player_room_map[challenger_ws] = room_id
 
                     challenger_name = None
                     for w, n in list(lobby.items()):
@@ -531,19 +1177,7 @@ async def websocket_endpoint(websocket: WebSocket):
                     acceptor_name = player_name
 
                     game_id = create_game_record(room_id, challenger_name, acceptor_name)
-                    rooms[room_id] = {
-                        "players": {websocket: acceptor_name, challenger_ws: challenger_name},
-                        "player_colors": {challenger_name: 'red', acceptor_name: 'black'},
-                        "turn": "red",
-                        "state": init_board(),
-                        "game_id": game_id,
-                        "move_count": 0,
-                        "clocks": {"red": 300, "black": 300},
-                        "timer_task": None,
-                        "rematch_offered_by": None
-                    }
-
-                    rooms[room_id]["timer_task"] = asyncio.create_task(timer_loop(room_id))
+                    open_room(room_id, challenger_ws, challenger_name, websocket, acceptor_name, game_id)
 
                     await websocket.send_text(json.dumps({"type": "game_start", "room_id": room_id, "color": "black", "opponent": challenger_name}, ensure_ascii=False))
                     await challenger_ws.send_text(json.dumps({"type": "game_start", "room_id": room_id, "color": "red", "opponent": acceptor_name}, ensure_ascii=False))
@@ -593,7 +1227,20 @@ async def websocket_endpoint(websocket: WebSocket):
                         await websocket.send_text(json.dumps({"type":"error","reason":"Game đã kết thúc"}, ensure_ascii=False))
                         continue
 
-                    valid, reason = is_valid_move(game["state"]["board"], move, player_color)
+                    if shutting_down:
+                        await websocket.send_text(json.dumps({"type":"error","reason":"Máy chủ đang khởi động lại, vui lòng chờ"}, ensure_ascii=False))
+                        continue
+
+                    # Thế cờ khai cuộc phổ biến: kiểm tra bằng tập nước đi đã cache
+                    board = game["state"]["board"]
+                    valid, reason = False, ""
+                    if game.get("move_count", 0) < OPENING_BOOK_DEPTH:
+                        pos_hash = position_hash(board, player_color)
+                        if is_hot_position(pos_hash):
+                            mkey = move_key(move["from"]["x"], move["from"]["y"], move["to"]["x"], move["to"]["y"])
+                            valid = mkey in get_legal_moves(board, player_color, pos_hash)
+                    if not valid:
+                        valid, reason = is_valid_move(board, move, player_color)
                     if not valid:
                         await websocket.send_text(json.dumps({"type":"error","reason":reason}, ensure_ascii=False))
                         continue
@@ -603,10 +1250,13 @@ async def websocket_endpoint(websocket: WebSocket):
                     apply_move(game["state"], move)
 
                     opponent_color = get_opponent_color(player_color)
-                    if is_king_in_check(game["state"]["board"], opponent_color):
+                    if is_king_in_check(board, opponent_color):
                         is_check_alert = True
 
                     idx = game.get("move_count", 0) + 1
+                    if idx <= OPENING_BOOK_DEPTH:
+                        game.setdefault("book_moves", []).append(
+                            move_key(fx, fy, move["to"]["x"], move["to"]["y"]))
                     add_move_record(game["game_id"], idx, fx, fy, move["to"]["x"], move["to"]["y"], piece)
                     game["move_count"] = idx
 
@@ -636,6 +1286,9 @@ async def websocket_endpoint(websocket: WebSocket):
                     if game.get("game_id") is not None:
                         await websocket.send_text(json.dumps({"type":"error","reason":"Game chưa kết thúc"}))
                         continue
+                    if game.get("tournament_id"):
+                        await websocket.send_text(json.dumps({"type":"error","reason":"Không thể chơi lại trong giải đấu"}, ensure_ascii=False))
+                        continue
 
                     player = game["players"].get(websocket)
 
@@ -647,6 +1300,7 @@ async def websocket_endpoint(websocket: WebSocket):
                         game["state"] = init_board()
                         game["turn"] = "red"
                         game["move_count"] = 0
+                        game["book_moves"] = []
                         game["game_id"] = game_id
                         game["clocks"] = {"red": 300, "black": 300}
                         game["rematch_offered_by"] = None
@@ -666,6 +1320,43 @@ async def websocket_endpoint(websocket: WebSocket):
                         await websocket.send_text(json.dumps({"type":"system", "text": "Đã gửi lời mời chơi lại."}, ensure_ascii=False))
                 continue
 
+            # ---------- TOURNAMENT CREATE ----------
+            if msg_type == "tournament_create":
+                if not player_name: continue
+                fmt = msg.get("format", "swiss")
+                if fmt not in TOURNAMENT_FORMATS:
+                    await websocket.send_text(json.dumps({"type":"error","reason":"Thể thức giải không hợp lệ"}, ensure_ascii=False))
+                    continue
+                try:
+                    rounds = max(1, int(msg.get("rounds", 5)))
+                    duration = max(60, int(msg.get("duration", 30)) * 60)
+                    start_in = max(0, int(msg.get("start_in", 60)))
+                except (TypeError, ValueError):
+                    await websocket.send_text(json.dumps({"type":"error","reason":"Tham số giải không hợp lệ"}, ensure_ascii=False))
+                    continue
+
+                async with lock:
+                    t = create_tournament(msg.get("name"), fmt, player_name, rounds, duration, start_in)
+                    tournament_add_player(t, player_name)
+                spawn_tournament_task(tournament_scheduler(t["id"]))
+                print(f"[TOURNAMENT] {player_name} created {fmt} {t['id']} starting in {start_in}s")
+                await broadcast_to_lobby({"type":"tournament_update", "tournament": tournament_summary(t)})
+                continue
+
+            # ---------- TOURNAMENT JOIN ----------
+            if msg_type == "tournament_join":
+                if not player_name: continue
+                async with lock:
+                    t = tournaments.get(msg.get("tournament_id"))
+                    # Arena cho phép vào muộn, Swiss chỉ nhận người trước khi bắt đầu
+                    if not t or t["status"] == "finished" or (t["status"] == "running" and t["format"] != "arena"):
+                        await websocket.send_text(json.dumps({"type":"error","reason":"Không thể tham gia giải này"}, ensure_ascii=False))
+                        continue
+                    tournament_add_player(t, player_name)
+                await websocket.send_text(json.dumps({"type":"system","text":f"Đã tham gia giải {t['name']}."}, ensure_ascii=False))
+                await broadcast_to_lobby({"type":"tournament_update", "tournament": tournament_summary(t)})
+                continue
+
             # ---------- LEAVE_GAME ----------
             if msg_type == "leave_game":
                 room_id = player_room_map.get(websocket)
@@ -698,7 +1389,14 @@ async def websocket_endpoint(websocket: WebSocket):
 # --- ĐÂY LÀ PHẦN CODE MỚI THÊM VÀO CUỐI FILE ---
 # Nó cho phép bạn chạy file bằng lệnh `python main.py`
 # và tự động lấy PORT từ môi trường (như Render)
+class GracefulServer(uvicorn.Server):
+    # Đánh dấu đang tắt ngay khi nhận SIGTERM/SIGINT, để việc uvicorn đóng websocket
+    # không bị coi là người chơi bỏ cuộc
+    def handle_exit(self, sig, frame):
+        begin_shutdown()
+        super().handle_exit(sig, frame)
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     print(f"--- Starting server on 0.0.0.0:{port} ---")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    GracefulServer(uvicorn.Config(app, host="0.0.0.0", port=port)).run()
\ No newline at end of file